@@ -0,0 +1,97 @@
+"""Date helpers for the finance plots: fast datetime64 to matplotlib date
+number conversion and date axis tick setup.
+"""
+
+import copy
+import datetime
+
+import numpy as np
+import matplotlib.dates as mdates
+
+
+NS_PER_DAY = 86400 * 10**9
+
+
+def datetime64_to_num(values):
+    """Convert datetime64 values to matplotlib date numbers.
+
+    :arg values:    Array of numpy datetime64 values (e.g., index.values).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :returns:   Float64 array equal to mdates.date2num(values) but computed
+                directly from the int64 nanosecond view instead of going
+                through python datetime objects.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    The date number of 1970-01-01 depends on matplotlib's date epoch, so we
+    look it up on each call rather than at import. Doing it at import would
+    fix the epoch and make any later mdates.set_epoch call fail.
+
+    """
+    epoch = mdates.date2num(datetime.datetime(1970, 1, 1))
+    values = values.astype('datetime64[ns]')
+    nums = values.view('i8') / NS_PER_DAY + epoch
+    return np.where(np.isnat(values), np.nan, nums)  # NaT -> nan like date2num
+
+
+def set_date_ticks(axis, formatter, major_loc, minor_loc=None):
+    """Attach copies of the given formatter and locators to axis.
+
+    Matplotlib binds a locator or formatter to the axis it is set on, so the
+    plot modules keep module level templates and pass them through here to
+    give each new axis its own copy. The copies are deep since date
+    locators keep an rrule wrapper which tick_values updates in place; the
+    templates are never attached to an axis so this stays cheap.
+    """
+    axis.set_major_formatter(copy.deepcopy(formatter))
+    axis.set_major_locator(copy.deepcopy(major_loc))
+    if minor_loc is not None:
+        axis.set_minor_locator(copy.deepcopy(minor_loc))
+
+
+def _regr_test_datetime64_to_num():
+    """
+
+>>> import os, numpy, pandas
+>>> import matplotlib.dates as mdates
+>>> from ox_plot.finance import barplot, intraday, _dates
+>>> if hasattr(mdates, 'set_epoch'):  # importing must not fix the epoch
+...     mdates.set_epoch('1970-01-01T00:00:00')
+>>> infile = os.path.join(os.path.dirname(_dates.__file__), '_test_data.csv')
+>>> data = pandas.read_csv(infile, parse_dates=[0], index_col=0)
+>>> numpy.array_equal(_dates.datetime64_to_num(data.index.values),
+...                   mdates.date2num(data.index.to_pydatetime()))
+True
+>>> with_nat = data.index[:3].insert(1, pandas.NaT)
+>>> numpy.array_equal(_dates.datetime64_to_num(with_nat.values),
+...                   mdates.date2num(with_nat.values), equal_nan=True)
+True
+"""
+
+
+def _regr_test_set_date_ticks():
+    """
+
+>>> import matplotlib
+>>> matplotlib.use('PS')
+>>> import matplotlib.pyplot as plt
+>>> from matplotlib.dates import DateFormatter, MinuteLocator
+>>> from ox_plot.finance import _dates
+>>> fmt, loc = DateFormatter('%H:%M'), MinuteLocator(byminute=[0, 30])
+>>> axes = [plt.figure().add_subplot(1, 1, 1) for _ in range(2)]
+>>> for ax in axes:
+...     _dates.set_date_ticks(ax.xaxis, fmt, loc)
+>>> first, second = [ax.xaxis.get_major_locator() for ax in axes]
+>>> first is loc, first is second
+(False, False)
+>>> first.rule is second.rule, first.rule is loc.rule
+(False, False)
+"""
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+    print('Finished tests')
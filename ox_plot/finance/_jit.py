@@ -0,0 +1,42 @@
+"""Optional numba compilation of numeric kernels.
+
+Numba is not a required dependency and is slow to import, so kernels are
+only compiled the first time they are called.
+"""
+
+import functools
+
+
+def lazy_njit(loop_func, fallback, **jit_kw):
+    """Return a function which runs loop_func compiled with numba.
+
+    :arg loop_func:  Plain python function written so numba.njit can compile
+                     it (e.g., explicit loops over numpy arrays).
+
+    :arg fallback:   Function with the same signature and results as
+                     loop_func to use if numba is not installed (usually a
+                     vectorized numpy version).
+
+    :arg **jit_kw:   Passed on to numba.njit.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :returns:   A function that, on first call, imports numba and compiles
+                loop_func (or picks fallback if numba is missing) and then
+                forwards every call to the chosen implementation.
+
+    """
+    chosen = []
+
+    @functools.wraps(loop_func)
+    def run(*args):
+        if not chosen:
+            try:
+                from numba import njit
+            except ImportError:
+                chosen.append(fallback)
+            else:
+                chosen.append(njit(**jit_kw)(loop_func))
+        return chosen[0](*args)
+
+    return run
@@ -1,21 +1,42 @@
 """Tools for making bar plots for finance data.
 """
 
+import collections
+import datetime
+import functools
 import tempfile
 import os
 import subprocess
 import logging
+import weakref
 
+import numpy as np
 import pandas
 import matplotlib              # Need these lines to prevent emacs hanging or
 matplotlib.interactive(False)  # exceptions when using non-GUI virtual machine
 matplotlib.use('PS')           # in an interactive session 
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter, MonthLocator
-from matplotlib.finance import candlestick_ohlc
 from aocks import aocksplot
 
+from ox_plot.finance._candlestick import add_candlesticks
+from ox_plot.finance._dates import datetime64_to_num, set_date_ticks
+from ox_plot.finance._jit import lazy_njit
+
+
+# Ordinal of the numpy datetime64 epoch so that day counts since 1970-01-01
+# can be shifted to match datetime.date.toordinal.
+_ORDINAL_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+# Quarterly month ticks for the daily price axis (see set_date_ticks).
+_MONTH_FMT = DateFormatter('%b %y')  # e.g., Jan 12
+_QUARTER_LOC = MonthLocator([3, 6, 9, 12])
+
+# Prepared plot data keyed on (id(orig_data), len(orig_data), start_end_date,
+# mode) with values (weakref to orig_data, prepared DataFrame). Entries are
+# dropped once orig_data is garbage collected; see _cached_prep_plot_data.
+_PREP_CACHE = collections.OrderedDict()
+_PREP_CACHE_SIZE = 8
+
 
 def prep_plot_data(orig_data, start_end_date=(None, None), mode=None):
     """Prepare pandas DataFrame for plotting.
@@ -30,41 +51,121 @@ def prep_plot_data(orig_data, start_end_date=(None, None), mode=None):
     ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
     :returns:   A DataFrame with Date, Open, Close, High, Low data suitable
-                for plotting. This is meant as a helper function.
+                for plotting and a plain RangeIndex (the original dates
+                are converted into the 'date' column). This is meant as a
+                helper function.
 
     ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
     PURPOSE:    Helper for simple_pandas_plot.
 
     """
-
     mode = mode if mode is not None else infer_data_mode(orig_data)
-    data = orig_data.copy(deep=True)
-    data = data.truncate(*start_end_date)
-    if mode == 'pion':
+    # truncate returns a new (narrowed) frame so we never need to copy all
+    # of orig_data before the in place edits below
+    data = orig_data.truncate(*start_end_date)
+    if mode == 'pandas':
+        # the dates live on the index; convert them to 'float days' directly
+        # and swap in a RangeIndex instead of paying for reset_index
+        dates = datetime64_to_num(data.index.values)
+        data.index = pandas.RangeIndex(len(data))
+        if 'date' in data:
+            data['date'] = dates
+        else:
+            data.insert(0, 'date', dates)
+    else:
+        assert mode == 'pion'
         renames=dict([(item, (item[0].upper() + item[1:]))
                       for item in data if item != 'event_date'])
         data.rename(columns=renames, inplace=True)
-        dateField = 'event_date'
-    else:
-        dateField = 'date'
 
-    # drop the date index from the dateframe
-    data.reset_index(inplace = True)
+        # drop the date index from the dateframe
+        data.reset_index(inplace = True)
 
-    # convert the datetime64 column in the dataframe to 'float days'
-    if mode == 'pandas':
-        data.date = mdates.date2num(getattr(data, dateField).dt.to_pydatetime())
-    else:
-        assert mode == 'pion'
-        data['date'] = [thing.toordinal() for thing in getattr(data, dateField)]
+        # convert the event dates in the dataframe to ordinal days; for tz
+        # aware dates use the local wall clock day (as toordinal does)
+        # rather than the UTC day that .values would give
+        event_dates = data['event_date']
+        if getattr(event_dates.dtype, 'tz', None) is not None:
+            event_dates = event_dates.dt.tz_localize(None)
+        data['date'] = event_dates.values.astype(
+            'datetime64[D]').astype('int64') + _ORDINAL_EPOCH
+
+    return data
+
+
+def _drop_prep_entry(key, ref):
+    """Weakref callback to remove a _PREP_CACHE entry once its input dies.
+    """
+    entry = _PREP_CACHE.get(key)
+    if entry is not None and entry[0] is ref:
+        del _PREP_CACHE[key]
+
+
+def _cached_prep_plot_data(orig_data, start_end_date, mode):
+    """Like prep_plot_data but reuses the result of an earlier call.
 
+    A result is reused when orig_data is the same object with the same
+    length and the other arguments match, so in place edits which keep the
+    length are not noticed. The result is shared and must not be modified.
+    """
+    try:
+        key = (id(orig_data), len(orig_data), tuple(start_end_date), mode)
+        hash(key)
+    except TypeError:  # unhashable dates so just skip the cache
+        return prep_plot_data(orig_data, start_end_date, mode)
+    entry = _PREP_CACHE.get(key)
+    if entry is not None and entry[0]() is orig_data:
+        _PREP_CACHE.move_to_end(key)
+        return entry[1]
+    data = prep_plot_data(orig_data, start_end_date, mode)
+    _PREP_CACHE[key] = (weakref.ref(
+        orig_data, functools.partial(_drop_prep_entry, key)), data)
+    _PREP_CACHE.move_to_end(key)
+    while len(_PREP_CACHE) > _PREP_CACHE_SIZE:
+        _PREP_CACHE.popitem(last=False)
     return data
 
 
+def _split_up_down_loop(open_, close_, date_, volume_):
+    """Split date and volume into (up_date, up_vol, down_date, down_vol).
+
+    A bar is up when open_ <= close_. All inputs must be numeric arrays of
+    the same length; this is written as an explicit loop so numba can
+    compile it to a single pass. The outputs are float64.
+    """
+    num = open_.shape[0]
+    up_d, up_v = np.empty(num), np.empty(num)
+    dn_d, dn_v = np.empty(num), np.empty(num)
+    k = j = 0
+    for i in range(num):
+        if open_[i] <= close_[i]:
+            up_d[k] = date_[i]
+            up_v[k] = volume_[i]
+            k += 1
+        else:
+            dn_d[j] = date_[i]
+            dn_v[j] = volume_[i]
+            j += 1
+    return up_d[:k], up_v[:k], dn_d[:j], dn_v[:j]
+
+
+def _split_up_down_numpy(open_, close_, date_, volume_):
+    """Same as _split_up_down_loop but using boolean masks.
+    """
+    pos = open_ <= close_
+    neg = ~pos
+    return date_[pos], volume_[pos], date_[neg], volume_[neg]
+
+
+_split_up_down = lazy_njit(_split_up_down_loop, _split_up_down_numpy,
+                           cache=True)
+
+
 def simple_pandas_plot(orig_data, output_file=None, mainTitle='', 
                        start_end_date = (None, None),
-                       pltargs=(('width', .3), ('colorup', 'b'))):
+                       pltargs=(('width', .3), ('colorup', 'b')), fig=None,
+                       cache_prep=False):
     """Plot pandas DataFrame
 
     :arg orig_data: A pandas DataFrame containing open, high, low, close,
@@ -75,9 +176,17 @@ def simple_pandas_plot(orig_data, output_file=None, mainTitle='',
     :arg start_end_date: Option tuple of start, end dates.
 
     :arg pltargs=:  Options such that dict(pltargs) can be passed to
-                    candlestick_ohlc. Example keys include 'width'
+                    add_candlesticks. Example keys include 'width'
                     and 'colorup'.
 
+    :arg fig=None:  Optional existing matplotlib figure. If given, it is
+                    cleared and reused instead of creating a new figure.
+
+    :arg cache_prep=False:  If True, reuse the data prepared by an earlier
+                    call with the same orig_data object (and length) and
+                    start_end_date. Only use this when orig_data is not
+                    modified in place between calls.
+
     ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
     :returns:   The matplotlib figure object for the plot.
@@ -87,9 +196,21 @@ def simple_pandas_plot(orig_data, output_file=None, mainTitle='',
     PURPOSE:    Take pandas data and make a nice stock plot.
 
     """
-    data = prep_plot_data(orig_data, start_end_date, mode='pandas')
+    # pyplot is slow to import so only load it when plotting
+    import matplotlib.gridspec
+    import matplotlib.pyplot as plt
+
+    prep = _cached_prep_plot_data if cache_prep else prep_plot_data
+    data = prep(orig_data, start_end_date, 'pandas')
+    # the candles and the volume bars below share these column arrays
+    date_, open_, high, low, close, volume = [
+        data[name].to_numpy() for name in (
+            'date', 'open', 'high', 'low', 'close', 'volume')]
     
-    fig = plt.figure(figsize=(8,6))
+    if fig is None:
+        fig = plt.figure(figsize=(8,6))
+    else:
+        fig.clear()
     gs = matplotlib.gridspec.GridSpec(2,1, height_ratios=[4,1])
     ax1 = fig.add_subplot(gs[0])        
     ax_vol = fig.add_subplot(gs[1], sharex=ax1)
@@ -101,27 +222,21 @@ def simple_pandas_plot(orig_data, output_file=None, mainTitle='',
     plt.setp(axes, title='')
     fig.suptitle(mainTitle, size=20)
 
-    majorFormatter = DateFormatter('%b %y')  # e.g., Jan 12
-
     fig.subplots_adjust(bottom=0.2)
-    ax1.xaxis.set_major_locator(MonthLocator([3,6,9,12]))
-    ax1.xaxis.set_major_formatter(majorFormatter)
-    candlestick_ohlc(ax1, [tuple(x) for x in data[
-        ['date', 'open', 'high', 'low', 'close']].to_records(index=False)],
-                     **dict(pltargs))
+    set_date_ticks(ax1.xaxis, _MONTH_FMT, _QUARTER_LOC)
+    add_candlesticks(ax1, date_, open_, high, low, close, **dict(pltargs))
     ax1.grid(True)
     ax1.xaxis_date()
     ax1.autoscale_view()
-    plt.setp(plt.gca().get_xticklabels(), rotation=45,
+    plt.setp(fig.gca().get_xticklabels(), rotation=45,
              horizontalalignment='right')
 
     # make bar plots and color differently depending on up/down for the day
-    pos = list((data['open']-data['close'])<=0)
-    neg = list((data['open']-data['close'])>0)
-#    ax_vol.bar(list(data['date'][pos]),list(data['volume'][pos]),
-#            color='b',width=.1,align='center',edgecolor='none')
-#    ax_vol.bar(list(data['date'][neg]),list(data['volume'][neg]),
-#            color='r',width=.1,align='center',edgecolor='none')
+    up_d, up_v, dn_d, dn_v = _split_up_down(open_, close, date_, volume)
+    ax_vol.bar(up_d, up_v, color='b', width=.1, align='center',
+               edgecolor='none')
+    ax_vol.bar(dn_d, dn_v, color='r', width=.1, align='center',
+               edgecolor='none')
 
     #for my_ax in axes:
     #    clean_axis(my_ax) #FIXME
@@ -155,6 +270,99 @@ True
 False
 """
 
+
+def _regr_test_split_up_down():
+    """
+
+>>> import numpy as np
+>>> from ox_plot.finance import barplot
+>>> rng = np.random.RandomState(7)
+>>> open_, close, date_, volume = rng.rand(4, 50)
+>>> close[3] = np.nan
+>>> expected = barplot._split_up_down_numpy(open_, close, date_, volume)
+>>> all(np.array_equal(got, want) for got, want in zip(
+...     barplot._split_up_down_loop(open_, close, date_, volume), expected))
+True
+>>> all(np.array_equal(got, want) for got, want in zip(
+...     barplot._split_up_down(open_, close, date_, volume), expected))
+True
+"""
+
+
+def _regr_test_prep_plot_data_pandas():
+    """
+
+>>> import os, pandas
+>>> from ox_plot.finance import barplot
+>>> infile = os.path.join(os.path.dirname(barplot.__file__), '_test_data.csv')
+>>> data = pandas.read_csv(infile, parse_dates=[0], index_col=0)
+>>> prepped = barplot.prep_plot_data(data, mode='pandas')
+>>> list(prepped.columns)
+['date', 'open', 'high', 'low', 'close', 'volume']
+>>> prepped.index.equals(pandas.RangeIndex(len(data)))
+True
+>>> prepped.sort_values('date').index.equals(prepped.index)
+True
+>>> isinstance(data.index, pandas.DatetimeIndex)  # input is untouched
+True
+"""
+
+
+def _regr_test_cached_prep_plot_data():
+    """
+
+>>> import gc, os, pandas
+>>> from ox_plot.finance import barplot
+>>> infile = os.path.join(os.path.dirname(barplot.__file__), '_test_data.csv')
+>>> data = pandas.read_csv(infile, parse_dates=[0], index_col=0)
+>>> fig = barplot.simple_pandas_plot(data)  # caching is opt-in
+>>> len(barplot._PREP_CACHE)
+0
+>>> first = barplot._cached_prep_plot_data(data, (None, None), 'pandas')
+>>> barplot._cached_prep_plot_data(data, (None, None), 'pandas') is first
+True
+>>> data.loc[data.index[-1] + pandas.Timedelta('1min')] = data.iloc[-1]
+>>> again = barplot._cached_prep_plot_data(data, (None, None), 'pandas')
+>>> again is first, len(again) - len(first)
+(False, 1)
+>>> key = (id(data), len(data), (None, None), 'pandas')
+>>> key in barplot._PREP_CACHE
+True
+>>> del data, first, again
+>>> _ = gc.collect()
+>>> key in barplot._PREP_CACHE, len(barplot._PREP_CACHE)
+(False, 0)
+"""
+
+
+def _regr_test_prep_plot_data_pion():
+    """
+
+>>> import datetime, pandas
+>>> from ox_plot.finance import barplot
+>>> days = [datetime.date(1999, 12, 31), datetime.date(2014, 3, 4)]
+>>> data = pandas.DataFrame({'open': [1.0, 2.0]}, index=pandas.Index(
+...     days, name='event_date'))
+>>> prepped = barplot.prep_plot_data(data, mode='pion')
+>>> list(prepped['date']) == [day.toordinal() for day in days]
+True
+>>> stamps = pandas.to_datetime(['1960-01-01 23:00', '2014-03-04 15:00'])
+>>> data = pandas.DataFrame({'open': [1.0, 2.0]}, index=pandas.Index(
+...     stamps, name='event_date'))
+>>> prepped = barplot.prep_plot_data(data, mode='pion')
+>>> list(prepped['date']) == [stamp.toordinal() for stamp in stamps]
+True
+>>> stamps = pandas.to_datetime(['2014-03-04 21:00', '2014-03-05 01:00']
+...     ).tz_localize('US/Eastern')
+>>> data = pandas.DataFrame({'open': [1.0, 2.0]}, index=pandas.Index(
+...     stamps, name='event_date'))
+>>> prepped = barplot.prep_plot_data(data, mode='pion')
+>>> list(prepped['date']) == [stamp.toordinal() for stamp in stamps]
+True
+>>> list(prepped['date'])
+[735296, 735297]
+"""
+
     
 if __name__ == '__main__':
     import doctest
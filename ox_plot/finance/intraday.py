@@ -1,23 +1,31 @@
 """Tools for making bar plots for intraday finance data.
 """
 
-import logging
+import functools
 
+import numpy as np
+import pandas
 import matplotlib              # Need these lines to prevent emacs hanging or
 matplotlib.interactive(False)  # exceptions when using non-GUI virtual machine
 matplotlib.use('PS')           # in an interactive session
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 from matplotlib.dates import (
     DateFormatter, MonthLocator, num2date, HourLocator, MinuteLocator)
 
-try:
-    from matplotlib.finance import candlestick2_ohlc
-except ImportError:
-    logging.warning('Unable to import matplotlib.finance; try mpl_finance')
-    from mpl_finance import candlestick2_ohlc, candlestick_ohlc
+from ox_plot.finance._candlestick import add_candlesticks
+from ox_plot.finance._dates import datetime64_to_num, set_date_ticks
 
 
+# Hour:minute tick formatter and minute locators chosen by BSizeParams.
+_HOUR_MIN_FMT = DateFormatter('%H:%M')
+_MINUTE_LOC = MinuteLocator()
+_HALF_HOUR_LOC = MinuteLocator(byminute=[0,30], interval=1)
+_QUARTER_HOUR_LOC = MinuteLocator(byminute=[0,15,30,45], interval=1)
+
+# Candle width for each supported bar size, precomputed since the set of
+# sizes is small and fixed.
+_BAR_WIDTH = {'%dmin' % minutes: minutes*.9*60./4.0/(3600.*6.5)
+              for minutes in (1, 5, 15)}
+
 
 class BSizeParams:
     """Parameters to adjust plot based on bar size.
@@ -28,53 +36,154 @@ class BSizeParams:
         self.minor_loc = None
         self.major_loc = None
         self.width = 1.0
-        self.formatter = DateFormatter('%H:%M')
+        self.formatter = _HOUR_MIN_FMT
         self.set_from_bsize(bsize)
 
     def set_from_bsize(self, bsize):
         """Set parameters based on the given bsize.
 
-        The bsize argument must be in [1, 5, 15].
-        """
-        func = getattr(self, 'set_from_bsize_' + bsize.lower())
-        return func()
-
-    @staticmethod
-    def get_width(minutes):
-        """Get width parameter for a plot with the given minutes bar size.
+        The bsize argument must be one of '1Min', '5Min', '15Min'
+        (case insensitive).
         """
-        return minutes*.9*60./4.0/(3600.*6.5)
+        try:
+            func = type(self)._DISPATCH[bsize.lower()]
+        except KeyError:
+            raise ValueError('Unsupported bsize %r; expected one of %s' % (
+                bsize, sorted(self._DISPATCH)))
+        return func(self)
 
     def set_from_bsize_15min(self):
-        self.width = self.get_width(15)
-        self.minor_loc = MinuteLocator()
-        self.major_loc = MinuteLocator(byminute=[0,30], interval=1)
-        self.formatter = DateFormatter('%H:%M')
+        self.width = _BAR_WIDTH['15min']
+        self.minor_loc = _MINUTE_LOC
+        self.major_loc = _HALF_HOUR_LOC
+        self.formatter = _HOUR_MIN_FMT
 
     def set_from_bsize_5min(self):
-        self.width = self.get_width(5)
-        self.minor_loc = MinuteLocator()
-        self.major_loc = MinuteLocator(byminute=[0,15,30,45], interval=1)
-        self.formatter = DateFormatter('%H:%M')
+        self.width = _BAR_WIDTH['5min']
+        self.minor_loc = _MINUTE_LOC
+        self.major_loc = _QUARTER_HOUR_LOC
+        self.formatter = _HOUR_MIN_FMT
 
     def set_from_bsize_1min(self):
-        self.width = self.get_width(1)
-        self.minor_loc = MinuteLocator()
-        self.major_loc = MinuteLocator(byminute=[0,15,30,45], interval=1)
-        self.formatter = DateFormatter('%H:%M')
+        self.width = _BAR_WIDTH['1min']
+        self.minor_loc = _MINUTE_LOC
+        self.major_loc = _QUARTER_HOUR_LOC
+        self.formatter = _HOUR_MIN_FMT
+
+    _DISPATCH = {'15min': set_from_bsize_15min,
+                 '5min': set_from_bsize_5min,
+                 '1min': set_from_bsize_1min}
+
+
+@functools.lru_cache(maxsize=8)
+def _bparams(bsize):
+    """Return a cached BSizeParams instance for the given bsize.
+
+    Callers must not mutate the result and should attach its locators and
+    formatter with set_date_ticks.
+    """
+    return BSizeParams(bsize)
+
+
+def _first_valid(values, starts, ends):
+    """Return the first non-NaN item of values[starts[i]:ends[i] + 1].
+
+    Bins with no valid item give NaN, matching pandas 'first'.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    pos = np.searchsorted(valid, starts)
+    found = valid[np.minimum(pos, len(valid) - 1)] if len(valid) else starts
+    ok = (pos < len(valid)) & (found <= ends)
+    return np.where(ok, values[found], np.nan)
+
+
+def _last_valid(values, starts, ends):
+    """Return the last non-NaN item of values[starts[i]:ends[i] + 1].
+
+    Bins with no valid item give NaN, matching pandas 'last'.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    pos = np.searchsorted(valid, ends, side='right') - 1
+    found = valid[np.maximum(pos, 0)] if len(valid) else ends
+    ok = (pos >= 0) & (found >= starts)
+    return np.where(ok, values[found], np.nan)
+
+
+def _resample_ohlcv(orig_data, bsize):
+    """Aggregate OHLCV bars in orig_data into bars of size bsize.
+
+    This gives the same bars as
+
+        orig_data.resample(bsize).agg({'open': 'first', 'high': 'max',
+            'low': 'min', 'close': 'last', 'volume': 'sum'})
+
+    including skipping NaN values and NaT index entries the way pandas
+    does, except that empty bins are dropped instead of filled with NaN. Rows are bucketed by
+    integer division of the nanosecond index and each column is then
+    reduced with a single numpy call.
+    """
+    columns = ['open', 'high', 'low', 'close', 'volume']
+    if orig_data.index.hasnans:  # resample ignores rows with a NaT index
+        orig_data = orig_data[orig_data.index.notna()]
+    if not len(orig_data):
+        return orig_data[columns].iloc[:0]
+    if not orig_data.index.is_monotonic_increasing:
+        orig_data = orig_data.sort_index()
+    step_ns = pandas.Timedelta(bsize).value
+    # the index may use s/ms/us units (pandas 2+) so convert to ns first
+    nanos = orig_data.index.values.astype('datetime64[ns]').view('i8')
+    bins = nanos // step_ns
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    ends = np.r_[starts[1:] - 1, len(bins) - 1]
+    index = pandas.DatetimeIndex(
+        (bins[starts] * step_ns).view('datetime64[ns]'),
+        name=orig_data.index.name)
+    if orig_data.index.tz is not None:
+        index = index.tz_localize('UTC').tz_convert(orig_data.index.tz)
+    open_, high, low, close, volume = [
+        orig_data[name].to_numpy(dtype=np.float64) for name in columns]
+    return pandas.DataFrame({
+        'open': _first_valid(open_, starts, ends),
+        'high': np.fmax.reduceat(high, starts),
+        'low': np.fmin.reduceat(low, starts),
+        'close': _last_valid(close, starts, ends),
+        'volume': np.add.reduceat(np.nan_to_num(volume), starts),
+        }, index=index)
 
 
-def plot(orig_data, bsize='1Min', **pltargs):
+def plot(orig_data, bsize='1Min', fig=None, bg=None, **pltargs):
+    """Make a candlestick plot of intraday data.
 
-    data = orig_data.resample(bsize).agg(
-        {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last',
-         'volume': 'sum'})
-    data['date'] = mdates.date2num(data.index.to_pydatetime())
-    bparams = BSizeParams(bsize)
+    :arg orig_data:   DataFrame with a DatetimeIndex and open, high, low,
+                      close, and volume columns.
 
-    fig = plt.figure(figsize=(10, 5))
+    :arg bsize='1Min':  Bar size; one of '1Min', '5Min', '15Min'.
+
+    :arg fig=None:    Optional existing matplotlib figure. If given, it is
+                      cleared and reused instead of creating a new figure.
+
+    :arg bg=None:     Optional background color for the axes (e.g., '.9').
+
+    :arg **pltargs:   Passed on to add_candlesticks.
+
+    :returns:   The matplotlib figure object for the plot.
+    """
+    import matplotlib.pyplot as plt
+
+    data = _resample_ohlcv(orig_data, bsize)
+    date_ = datetime64_to_num(data.index.values)
+    open_, high, low, close = [
+        data[name].to_numpy() for name in ('open', 'high', 'low', 'close')]
+    bparams = _bparams(bsize)
+
+    if fig is None:
+        fig = plt.figure(figsize=(10, 5))
+    else:
+        fig.clear()
 
     axes = fig.add_axes([0.1, 0.2, 0.85, 0.7])
+    if bg is not None:
+        axes.set_facecolor(bg)
     # customization of the axis
     axes.spines['right'].set_color('none')
     axes.spines['top'].set_color('none')
@@ -84,20 +193,18 @@ def plot(orig_data, bsize='1Min', **pltargs):
                    labelsize=12, pad=8)
     axes.spines['left'].set_linewidth(2)
     axes.spines['bottom'].set_linewidth(2)
-    candlestick_ohlc(axes, [tuple(x) for x in data[
-        ['date', 'open', 'high', 'low', 'close']].to_records(index=False)],
+    add_candlesticks(axes, date_, open_, high, low, close,
                      width=bparams.width, **pltargs)
     # FIXME: could do something like the following to plot trades
     #plt.plot([data.index[3]], [41], '^')
     #plt.plot([data.index[4]], [41], 'v')
-    axes.xaxis.set_major_formatter(bparams.formatter)
-    axes.xaxis.set_major_locator(bparams.major_loc)
-    axes.xaxis.set_minor_locator(bparams.minor_loc)
+    set_date_ticks(axes.xaxis, bparams.formatter, bparams.major_loc,
+                   bparams.minor_loc)
     axes.autoscale_view()
     axes.set_axisbelow(True)
     axes.yaxis.grid(color='.75', linestyle='dashed')
     axes.xaxis.grid(color='.75', linestyle='dashed')
-    plt.setp(plt.gca().get_xticklabels(), rotation=45,
+    plt.setp(axes.get_xticklabels(), rotation=45,
              horizontalalignment='right')
     return fig
 
@@ -124,6 +231,52 @@ False
 """
 
 
+def _regr_test_bsize_params():
+    """
+
+>>> from ox_plot.finance import intraday
+>>> intraday.BSizeParams('15MIN').major_loc is intraday._HALF_HOUR_LOC
+True
+>>> intraday.BSizeParams('2Min')
+Traceback (most recent call last):
+    ...
+ValueError: Unsupported bsize '2Min'; expected one of ['15min', '1min', '5min']
+"""
+
+
+def _regr_test_resample_ohlcv():
+    """
+
+>>> import os, numpy, pandas
+>>> from ox_plot.finance import intraday
+>>> infile = os.path.join(os.path.dirname(intraday.__file__), '_test_data.csv')
+>>> data = pandas.read_csv(infile, parse_dates=[0], index_col=0)
+>>> aggs = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last',
+...         'volume': 'sum'}
+>>> def check(frame, bsize):
+...     pandas.testing.assert_frame_equal(
+...         intraday._resample_ohlcv(frame, bsize),
+...         frame.resample(bsize).agg(aggs).dropna(),
+...         check_dtype=False, check_freq=False, check_index_type=False)
+>>> for bsize in ['1Min', '5Min', '15Min']:
+...     check(data, bsize)
+>>> gappy = data.drop(data.index[20:40]).astype(float)
+>>> gappy.iloc[[0, 5, 6, 11], [0, 1, 3, 4]] = numpy.nan
+>>> check(gappy, '5Min')
+>>> with_nat = data.iloc[:10].copy()
+>>> with_nat.index = with_nat.index.where(
+...     numpy.arange(10) != 4, pandas.NaT)
+>>> check(with_nat, '5Min')
+>>> len(intraday._resample_ohlcv(with_nat, '5Min'))
+2
+>>> if hasattr(data.index, 'as_unit'):  # pandas 2+ allows non-ns indexes
+...     check(data.set_axis(data.index.as_unit('s')), '5Min')
+>>> check(data.tz_localize('US/Eastern'), '15Min')
+>>> intraday._resample_ohlcv(data.iloc[:0], '5Min').empty
+True
+"""
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()